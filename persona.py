@@ -1,20 +1,124 @@
 import os
-import json
 import re
+import io
+import hashlib
+import heapq
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import redirect_stdout, redirect_stderr
 from datetime import datetime
-from PyPDF2 import PdfReader
-from sentence_transformers import SentenceTransformer, util
-from typing import List, Dict, Tuple
+from functools import lru_cache
+from itertools import chain
+import numpy as np
+import orjson
+import pymupdf
+from typing import List, Tuple, Optional, Iterable, Iterator, TYPE_CHECKING
+
+# torch and sentence_transformers are imported lazily (see load_model) so that
+# PDF-only worker processes and quick runs never pay for the transformer stack
+if TYPE_CHECKING:
+    import torch
+    from sentence_transformers import SentenceTransformer
 
 PDF_INPUT_DIR = "./input/PDF"
 INSTRUCTION_DIR = "./input"
 OUTPUT_DIR = "./output"
 MODEL_PATH = "./model/all-MiniLM-L6-v2"
+MODEL_PRECISION = "fp32"  # "fp32", "bf16" or "int8" (opt-in, see load_model)
+MAX_SEQ_LENGTH = 128  # tokens; attention cost grows quadratically with length
+SECTION_PREVIEW_CHARS = 256  # chars of section text encoded alongside the title
+CACHE_DIR = os.environ.get("PERSONA_CACHE_DIR", "./cache")
+# Embeddings are cached per model settings so a change never reuses stale vectors
+EMBEDDING_CACHE_DIR = os.path.join(
+    CACHE_DIR, "embeddings",
+    f"{os.path.basename(MODEL_PATH)}-{MODEL_PRECISION}-{MAX_SEQ_LENGTH}"
+)
 
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-# Load model on CPU
-model = SentenceTransformer(MODEL_PATH, device='cpu')
+# Must be set before tokenizers is imported; the model already runs multi-threaded
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+_SENTENCE_END_RE = re.compile(r'[.!?]+')
+# At most 6 whitespace-separated words (other header rules live in _make_header_checker)
+_HEADER_WORDS_RE = re.compile(r'\S+(?:\s+\S+){0,5}')
+
+def _make_header_checker():
+    """Build the header predicate with its lookups bound to locals, cheapest checks first"""
+    fullmatch = _HEADER_WORDS_RE.fullmatch
+    isupper = str.isupper
+    istitle = str.istitle
+    
+    def is_header(line: str) -> bool:
+        # Potential section headers: all caps, or title case with few words
+        return (
+            len(line) > 5 and
+            line[-1] != '.' and
+            line[0] != '•' and
+            (isupper(line) or istitle(line)) and
+            fullmatch(line) is not None
+        )
+    
+    return is_header
+
+_is_header = _make_header_checker()
+
+# Cores this process may use; instruction-level workers each get a share (_init_worker)
+_CPU_BUDGET = os.cpu_count() or 1
+
+# Loaded lazily by get_model(), so PDF worker processes never load it
+_MODEL = None
+# torch.set_num_interop_threads() may only be called once per process
+_TORCH_CONFIGURED = False
+
+def _configure_torch():
+    """Use this process's cores for intra-op parallelism and let oneDNN pick CPU kernels"""
+    global _TORCH_CONFIGURED
+    if _TORCH_CONFIGURED:
+        return
+    
+    import torch
+    torch.set_num_threads(_CPU_BUDGET)
+    torch.set_num_interop_threads(2)
+    torch.backends.mkldnn.enabled = True
+    _TORCH_CONFIGURED = True
+
+def load_model() -> "SentenceTransformer":
+    """Load the sentence transformer on CPU in the precision set by MODEL_PRECISION"""
+    if MODEL_PRECISION not in ("int8", "bf16", "fp32"):
+        raise ValueError(f"Unsupported MODEL_PRECISION: {MODEL_PRECISION}")
+    
+    import torch
+    from sentence_transformers import SentenceTransformer
+    
+    _configure_torch()
+    st_model = SentenceTransformer(MODEL_PATH, device='cpu')
+    st_model.max_seq_length = MAX_SEQ_LENGTH
+    st_model.eval()
+    
+    if MODEL_PRECISION == "int8":
+        # Int8 weights for every Linear layer; activations are quantized on the fly.
+        # torch.ao.quantization is deprecated in recent torch releases, hence opt-in.
+        torch.ao.quantization.quantize_dynamic(st_model, {torch.nn.Linear},
+                                               dtype=torch.qint8, inplace=True)
+    elif MODEL_PRECISION == "bf16":
+        # Halves model memory and uses AVX-512/AMX BF16 kernels where available
+        st_model.to(dtype=torch.bfloat16)
+    
+    return st_model
+
+def get_model() -> "SentenceTransformer":
+    """Return the process-wide model, loading it on first use"""
+    global _MODEL
+    if _MODEL is None:
+        _MODEL = load_model()
+    return _MODEL
+
+def _init_worker(cpu_budget: int):
+    """Limit an instruction-level worker to its share of cores to avoid oversubscription"""
+    global _CPU_BUDGET
+    _CPU_BUDGET = cpu_budget  # Applied to torch when the worker loads the model
 
 def find_instruction_files() -> List[str]:
     """Find all JSON instruction files in the input directory"""
@@ -32,8 +136,8 @@ def read_instruction(instruction_path: str):
     if not os.path.isfile(instruction_path):
         raise FileNotFoundError(f"Instruction JSON file not found: {instruction_path}")
     
-    with open(instruction_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    with open(instruction_path, "rb") as f:
+        data = orjson.loads(f.read())
     
     persona = data.get("persona", {}).get("role", "Researcher")
     job = data.get("job_to_be_done", {}).get("task", "Analyze documents")
@@ -43,55 +147,46 @@ def read_instruction(instruction_path: str):
     
     return persona, job, documents, challenge_info, test_case_name
 
-def extract_text_from_pdf(pdf_path: str) -> str:
-    """Extract text from PDF file"""
+def iter_pdf_lines(pdf_path: str) -> Iterator[Tuple[int, str]]:
+    """Yield (page_number, line) for each non-empty line of a PDF, one page at a time"""
     try:
-        reader = PdfReader(pdf_path)
-        text = ""
-        for page in reader.pages:
-            text += page.extract_text() or ""
-        return text.strip()
+        with pymupdf.open(pdf_path) as doc:
+            for page_number, page in enumerate(doc, start=1):
+                for line in page.get_text().splitlines():
+                    line = line.strip()
+                    if line:
+                        yield page_number, line
     except Exception as e:
         print(f"Error reading {pdf_path}: {e}")
-        return ""
 
-def split_into_sections(text: str, filename: str) -> List[Dict]:
-    """Split text into sections based on headings and content structure"""
-    sections = []
+def split_into_sections(lines: Iterable[Tuple[int, str]]) -> Tuple[List[str], List[str], List[int]]:
+    """Split (page_number, line) pairs into sections based on headings and content structure
+    
+    Lines must already be stripped and non-empty, as yielded by iter_pdf_lines.
+    Returns parallel lists of section titles, texts and start pages.
+    """
+    titles, texts, pages = [], [], []
     
     # Split by potential section markers (lines that look like headings)
-    lines = text.split('\n')
     current_section = []
     current_title = None
-    page_counter = 1
+    current_page = None  # Page the current section starts on
+    is_header_line = _is_header
     
-    for i, line in enumerate(lines):
-        line = line.strip()
-        if not line:
-            continue
+    for page_number, line in lines:
+        if current_page is None:
+            current_page = page_number
             
-        # Detect potential section headers (all caps, or title case with few words)
-        is_header = (
-            len(line.split()) <= 6 and 
-            (line.isupper() or line.istitle()) and 
-            len(line) > 5 and
-            not line.endswith('.') and
-            not line.startswith('•')
-        )
-        
-        if is_header and current_section:
+        if current_section and is_header_line(line):
             # Save previous section
             section_text = ' '.join(current_section).strip()
             if section_text and len(section_text) > 100:  # Only keep substantial sections
-                sections.append({
-                    'title': current_title or f"Section {len(sections) + 1}",
-                    'text': section_text,
-                    'page': page_counter,
-                    'filename': filename
-                })
+                titles.append(current_title or f"Section {len(titles) + 1}")
+                texts.append(section_text)
+                pages.append(current_page)
             current_section = []
             current_title = line
-            page_counter += 1
+            current_page = page_number
         else:
             current_section.append(line)
     
@@ -99,75 +194,143 @@ def split_into_sections(text: str, filename: str) -> List[Dict]:
     if current_section:
         section_text = ' '.join(current_section).strip()
         if section_text and len(section_text) > 100:
-            sections.append({
-                'title': current_title or f"Section {len(sections) + 1}",
-                'text': section_text,
-                'page': page_counter,
-                'filename': filename
-            })
+            titles.append(current_title or f"Section {len(titles) + 1}")
+            texts.append(section_text)
+            pages.append(current_page)
     
-    return sections
+    return titles, texts, pages
 
-def rank_sections_by_relevance(sections: List[Dict], persona: str, job: str) -> List[Dict]:
-    """Rank sections by relevance to the persona and job"""
-    query = f"Persona: {persona}. Task: {job}."
-    query_embedding = model.encode(query, convert_to_tensor=True, device='cpu')
+def _load_and_split(pdf_path: str) -> Optional[Tuple[List[str], List[str], List[int]]]:
+    """Extract and split a single PDF (runs in a worker process)"""
+    lines = iter_pdf_lines(pdf_path)
+    first_line = next(lines, None)
+    if first_line is None:
+        return None
+    return split_into_sections(chain([first_line], lines))
+
+def _encode(texts, **kwargs) -> "torch.Tensor":
+    """Encode into normalized fp32 embeddings without autograd (bf16 autocast if enabled)"""
+    import torch
     
-    scored_sections = []
+    with torch.inference_mode(), torch.autocast("cpu", dtype=torch.bfloat16,
+                                                enabled=MODEL_PRECISION == "bf16"):
+        embeddings = get_model().encode(texts, convert_to_tensor=True, device='cpu',
+                                        normalize_embeddings=True, **kwargs)
+    # Score in fp32 for numeric stability regardless of the model precision
+    return embeddings.float()
+
+def _embedding_key(text: str) -> str:
+    """Content hash used as the embedding cache key"""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+@lru_cache(maxsize=4096)
+def _load_cached_embedding(key: str) -> np.ndarray:
+    """Load a cached embedding from disk (raises on a missing or unreadable entry)"""
+    return np.load(os.path.join(EMBEDDING_CACHE_DIR, f"{key}.npy"))
+
+def encode_with_cache(texts: List[str]) -> np.ndarray:
+    """Encode texts into normalized embeddings, only running the model on cache misses"""
+    keys = [_embedding_key(text) for text in texts]
+    embeddings = [None] * len(texts)
+    missing = {}  # key -> indices, so duplicate texts are encoded once
+    
+    for i, key in enumerate(keys):
+        try:
+            embeddings[i] = _load_cached_embedding(key)
+        except Exception:
+            # Missing, truncated or corrupt entries are re-encoded and overwritten
+            missing.setdefault(key, []).append(i)
     
-    for section in sections:
-        # Use title + first part of text for similarity
-        section_repr = f"{section['title']} {section['text'][:500]}"
-        section_embedding = model.encode(section_repr, convert_to_tensor=True, device='cpu')
-        similarity = util.pytorch_cos_sim(query_embedding, section_embedding).item()
+    if missing:
+        missing_keys = list(missing)
+        new_embeddings = _encode([texts[missing[key][0]] for key in missing_keys],
+                                 batch_size=32, show_progress_bar=False).cpu().numpy()
+        try:
+            os.makedirs(EMBEDDING_CACHE_DIR, exist_ok=True)
+            for key, embedding in zip(missing_keys, new_embeddings):
+                # Write then rename so concurrent workers never load a partial file
+                cache_path = os.path.join(EMBEDDING_CACHE_DIR, f"{key}.npy")
+                tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+                try:
+                    with open(tmp_path, "wb") as f:
+                        np.save(f, embedding)
+                    os.replace(tmp_path, cache_path)
+                except OSError:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    raise
+        except OSError as e:
+            print(f"⚠️  Warning: could not write embedding cache: {e}")
         
-        scored_sections.append({
-            **section,
-            'similarity_score': similarity
-        })
+        for key, embedding in zip(missing_keys, new_embeddings):
+            for i in missing[key]:
+                embeddings[i] = embedding
     
-    # Sort by similarity score (descending)
-    return sorted(scored_sections, key=lambda x: x['similarity_score'], reverse=True)
+    return np.stack(embeddings)
 
-def select_top_sections(ranked_sections: List[Dict], max_sections: int = 5) -> List[Dict]:
-    """Select top sections ensuring diversity across documents"""
-    selected = []
-    used_documents = set()
+def rank_sections_by_relevance(titles: List[str], texts: List[str],
+                               persona: str, job: str) -> np.ndarray:
+    """Score sections by relevance to the persona and job (one score per section)"""
+    query = f"Persona: {persona}. Task: {job}."
+    query_embedding = _encode(query).cpu().numpy()
+    
+    # Use title + first part of text for similarity, encoded in a single batch
+    section_reprs = [f"{title} {text[:SECTION_PREVIEW_CHARS]}"
+                     for title, text in zip(titles, texts)]
+    section_embeddings = encode_with_cache(section_reprs)  # (N, dim) float32
+    
+    # Embeddings are normalized, so one matrix-vector product gives the cosine similarities
+    return section_embeddings @ query_embedding
+
+def select_top_sections(filenames: List[str], similarities: np.ndarray,
+                        max_sections: int = 5) -> List[int]:
+    """Select indices of top sections ensuring diversity across documents"""
+    scores = similarities.tolist()
     
     # First pass: select highest scoring section from each document
-    for section in ranked_sections:
-        if section['filename'] not in used_documents and len(selected) < max_sections:
-            selected.append(section)
-            used_documents.add(section['filename'])
-    
-    # Second pass: fill remaining slots with highest scoring sections
-    for section in ranked_sections:
-        if len(selected) >= max_sections:
-            break
-        if section not in selected:
-            selected.append(section)
+    best_per_document = {}
+    for i, filename in enumerate(filenames):
+        best = best_per_document.get(filename)
+        if best is None or scores[i] > scores[best]:
+            best_per_document[filename] = i
+    selected = sorted(best_per_document.values(), key=lambda i: (-scores[i], i))[:max_sections]
+    
+    # Second pass: fill remaining slots with highest scoring sections. Only the top
+    # max_sections + len(selected) can be needed; ties keep the lowest index first.
+    k = min(len(scores), max_sections + len(selected))
+    if k > len(selected):
+        candidates = heapq.nsmallest(k, range(len(scores)), key=lambda i: (-scores[i], i))
+        chosen = set(selected)
+        for i in candidates:
+            if len(selected) >= max_sections:
+                break
+            if i not in chosen:
+                selected.append(i)
+                chosen.add(i)
     
-    return selected[:max_sections]
+    return selected
 
 def refine_section_text(text: str, max_length: int = 800) -> str:
     """Refine and truncate section text to be more focused"""
     # Remove excessive whitespace
-    text = re.sub(r'\s+', ' ', text)
+    text = " ".join(text.split())
     
     # Split into sentences
-    sentences = re.split(r'[.!?]+', text)
+    sentences = _SENTENCE_END_RE.split(text)
     
-    refined_text = ""
+    refined_parts = []
+    refined_length = 0
     for sentence in sentences:
         sentence = sentence.strip()
         if not sentence:
             continue
             
-        if len(refined_text + sentence) > max_length:
+        if refined_length + len(sentence) > max_length:
             break
-        refined_text += sentence + ". "
+        refined_parts.append(sentence + ". ")
+        refined_length += len(sentence) + 2
     
-    return refined_text.strip()
+    return "".join(refined_parts).strip()
 
 def process_single_instruction(instruction_path: str) -> bool:
     """Process a single instruction file"""
@@ -182,10 +345,15 @@ def process_single_instruction(instruction_path: str) -> bool:
         print(f"🔹 Job: {job}")
         print(f"🔹 Test Case: {test_case_name}")
         
-        # Load and process all PDFs
-        all_sections = []
+        # Load and process all PDFs, keeping sections as parallel columns
+        section_titles = []
+        section_texts = []
+        section_pages = []
+        section_filenames = []
         processed_documents = []
         
+        pdf_paths = []
+        filenames = []
         for doc_info in document_list:
             filename = doc_info['filename']
             pdf_path = os.path.join(PDF_INPUT_DIR, filename)
@@ -195,22 +363,39 @@ def process_single_instruction(instruction_path: str) -> bool:
                 continue
                 
             print(f"📖 Processing: {filename}")
-            text = extract_text_from_pdf(pdf_path)
-            
-            if text:
-                sections = split_into_sections(text, filename)
-                all_sections.extend(sections)
+            pdf_paths.append(pdf_path)
+            filenames.append(filename)
+        
+        # Extract documents in parallel. Workers are spawned rather than forked because
+        # this process may already be running torch thread pools from an earlier file.
+        max_workers = min(_CPU_BUDGET, 8, len(pdf_paths))
+        if max_workers > 1:
+            with ProcessPoolExecutor(max_workers=max_workers,
+                                     mp_context=multiprocessing.get_context("spawn")) as executor:
+                results = list(executor.map(_load_and_split, pdf_paths))
+        else:
+            results = [_load_and_split(pdf_path) for pdf_path in pdf_paths]
+        
+        for filename, sections in zip(filenames, results):
+            if sections is not None:
+                titles, texts, pages = sections
+                section_titles.extend(titles)
+                section_texts.extend(texts)
+                section_pages.extend(pages)
+                section_filenames.extend([filename] * len(titles))
                 processed_documents.append(filename)
         
-        if not all_sections:
+        if not section_texts:
             print("❌ No sections found in any documents")
             return False
         
-        # Rank sections by relevance
-        ranked_sections = rank_sections_by_relevance(all_sections, persona, job)
+        section_pages = np.asarray(section_pages, dtype=np.int32)
+        
+        # Score sections by relevance
+        similarities = rank_sections_by_relevance(section_titles, section_texts, persona, job)
         
         # Select top sections
-        top_sections = select_top_sections(ranked_sections, max_sections=5)
+        top_sections = select_top_sections(section_filenames, similarities, max_sections=5)
         
         # Create output structure
         output = {
@@ -225,30 +410,31 @@ def process_single_instruction(instruction_path: str) -> bool:
         }
         
         # Add extracted sections
-        for i, section in enumerate(top_sections):
+        for rank, i in enumerate(top_sections, start=1):
+            page_number = int(section_pages[i])
             output["extracted_sections"].append({
-                "document": section['filename'],
-                "section_title": section['title'],
-                "importance_rank": i + 1,
-                "page_number": section['page']
+                "document": section_filenames[i],
+                "section_title": section_titles[i],
+                "importance_rank": rank,
+                "page_number": page_number
             })
             
             # Add subsection analysis
-            refined_text = refine_section_text(section['text'])
+            refined_text = refine_section_text(section_texts[i])
             output["subsection_analysis"].append({
-                "document": section['filename'],
+                "document": section_filenames[i],
                 "refined_text": refined_text,
-                "page_number": section['page']
+                "page_number": page_number
             })
         
         # Save output with dynamic filename based on test_case_name
         output_filename = f"{test_case_name}_output.json"
         output_path = os.path.join(OUTPUT_DIR, output_filename)
-        with open(output_path, "w", encoding="utf-8") as f:
-            json.dump(output, f, indent=4, ensure_ascii=False)
+        with open(output_path, "wb") as f:
+            f.write(orjson.dumps(output, option=orjson.OPT_INDENT_2))
         
         print(f"✅ Output saved to: {output_path}")
-        print(f"📊 Processed {len(all_sections)} sections from {len(processed_documents)} documents")
+        print(f"📊 Processed {len(section_texts)} sections from {len(processed_documents)} documents")
         print(f"🎯 Selected top {len(top_sections)} most relevant sections")
         
         return True
@@ -259,6 +445,22 @@ def process_single_instruction(instruction_path: str) -> bool:
         traceback.print_exc()
         return False
 
+def _process_instruction_buffered(instruction_path: str) -> Tuple[bool, str]:
+    """Process an instruction file in a worker, returning its log so parallel output stays readable"""
+    log = io.StringIO()
+    with redirect_stdout(log), redirect_stderr(log):
+        success = process_single_instruction(instruction_path)
+    return success, log.getvalue()
+
+def _collect_result(future, instruction_path: str) -> Tuple[Optional[bool], str]:
+    """Return (success, log) for a worker future; success is None if its process died"""
+    try:
+        return future.result()
+    except BrokenProcessPool:
+        return None, f"\n❌ Error processing {instruction_path}: worker process died\n"
+    except Exception as e:
+        return False, f"\n❌ Error processing {instruction_path}: {e}\n"
+
 def process_documents():
     """Main processing function - handles multiple instruction files"""
     instruction_files = find_instruction_files()
@@ -271,15 +473,38 @@ def process_documents():
     for file_path in instruction_files:
         print(f"   - {os.path.basename(file_path)}")
     
-    successful_count = 0
-    failed_count = 0
+    # Instruction files are independent, so process them in parallel. Each worker
+    # keeps a share of the cores for PyTorch intra-op threads and PDF extraction.
+    num_workers = min(len(instruction_files), max(1, _CPU_BUDGET // 2))
+    if num_workers > 1:
+        results = []
+        retry_files = []
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker,
+                                 initargs=(max(1, _CPU_BUDGET // num_workers),)) as executor:
+            futures = {executor.submit(_process_instruction_buffered, path): path
+                       for path in instruction_files}
+            for future in as_completed(futures):
+                success, log = _collect_result(future, futures[future])
+                if success is None:
+                    retry_files.append(futures[future])
+                    continue
+                print(log, end="")
+                results.append(success)
+        
+        # A dead worker (e.g. OOM) breaks the whole pool. Retry the affected files one at
+        # a time in their own process, so a crash only fails the file that caused it.
+        for path in sorted(retry_files):
+            with ProcessPoolExecutor(max_workers=1, initializer=_init_worker,
+                                     initargs=(_CPU_BUDGET,)) as executor:
+                success, log = _collect_result(
+                    executor.submit(_process_instruction_buffered, path), path)
+            print(log, end="")
+            results.append(bool(success))
+    else:
+        results = [process_single_instruction(path) for path in instruction_files]
     
-    for instruction_path in instruction_files:
-        success = process_single_instruction(instruction_path)
-        if success:
-            successful_count += 1
-        else:
-            failed_count += 1
+    successful_count = sum(results)
+    failed_count = len(results) - successful_count
     
     print(f"\n{'='*60}")
     print(f"🏁 BATCH PROCESSING COMPLETE")